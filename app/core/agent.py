@@ -1,126 +1,182 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from app.models.config import AppConfig
 from app.services.llm_service import LLMService, CodeContext, ReviewResult, QualityMetrics
 from app.core.scm import SCMProvider, CommitDiff, ReviewComment
 from loguru import logger
-import fnmatch
+from jinja2 import Environment
+import asyncio
 import os
 
+REPORT_TEMPLATE = """# 🔍 代码评审报告
+
+## 📊 评分概览 ({{ '%.1f'|format(result.score) }}/10)
+
+| 评审维度 | 得分 | 权重 |
+|---------|------|------|
+| 🛡️ 安全性 | {{ '%.1f'|format(result.quality_metrics.security_score) }}/10 | {{ '%.0f'|format(rules['security']) }} |
+| ⚡ 性能 | {{ '%.1f'|format(result.quality_metrics.performance_score) }}/10 | {{ '%.0f'|format(rules['performance']) }} |
+| 📖 可读性 | {{ '%.1f'|format(result.quality_metrics.readability_score) }}/10 | {{ '%.0f'|format(rules['readability']) }} |
+| ✨ 最佳实践 | {{ '%.1f'|format(result.quality_metrics.best_practice_score) }}/10 | {{ '%.0f'|format(rules['best_practice']) }} |
+{% if result.issues %}
+
+## 💡 需要改进的地方
+
+{% for issue in result.issues %}
+{% if not loop.first %}
+
+{% endif %}
+### {{ issue.file_path }}
+- 位置：第{{ issue.start_line }}行{% if issue.end_line %}-{{ issue.end_line }}行{% endif +%}
+- 问题：{{ issue.description }}
+- 建议：{{ issue.suggestion }}
+{% endfor %}
+{% endif %}
+{% if result.security_issues %}
+
+## ⚠️ 安全问题
+
+{% for issue in result.security_issues %}
+{% if not loop.first %}
+
+{% endif %}
+### {{ '🔴' if issue.severity.lower() == 'high' else '🟡' }} {{ issue.file_path }}
+- 严重程度：{{ issue.severity }}
+- 位置：第{{ issue.start_line }}行{% if issue.end_line %}-{{ issue.end_line }}行{% endif +%}
+- 问题：{{ issue.description }}
+- 建议：{{ issue.suggestion }}
+{% endfor %}
+{% endif %}
+"""
+
+# 报告模板在模块加载时编译一次
+_report_template = Environment(autoescape=False, trim_blocks=True).from_string(REPORT_TEMPLATE)
+
 class CodeReviewAgent:
+    __slots__ = (
+        "config", "scm", "llm",
+    )
+
     def __init__(self, config: AppConfig, scm: SCMProvider, llm: LLMService) -> None:
         self.config = config
         self.scm = scm
         self.llm = llm
-        logger.info("CodeReviewAgent initialized with model: {} and config: {}", config.llm.model, config.dict())
+        logger.opt(lazy=True).info("CodeReviewAgent initialized with model: {} and config: {}",
+                                   lambda: config.llm.model, lambda: config.model_dump())
 
     def _filter_files(self, files: List[dict]) -> List[dict]:
         """过滤不需要评审的文件"""
-        filtered = []
-        for file in files:
-            should_ignore = any(
-                fnmatch.fnmatch(file["filename"], pattern)
-                for pattern in self.config.review.ignore_patterns
-            )
-            if not should_ignore:
-                filtered.append(file)
-        return filtered
+        is_ignored = self.config.review.is_ignored
+        return [f for f in files if "filename" in f and not is_ignored(f["filename"])]
 
     async def _collect_context(self, owner: str, repo: str, commit_diff: CommitDiff) -> Optional[CodeContext]:
+        short_id = commit_diff.commit_id[:8]
         # 过滤文件
         filtered_files = self._filter_files(commit_diff.files)
         if not filtered_files:
             logger.info("No files to review after filtering for commit {} (changed files: {})", 
-                        commit_diff.commit_id[:8], len(commit_diff.files))
+                        short_id, len(commit_diff.files))
             return None
             
-        # 收集所有文件的上下文
-        files_context = []
+        # 并发获取所有文件的上下文，用信号量限制对SCM的并发请求数
         window_size = self.config.scm.context_window
-        
-        for file in filtered_files:
-            if "filename" not in file:
-                logger.error("Invalid file data - missing filename in commit: {}", commit_diff.commit_id[:8])
-                continue
-                
-            file_path = file["filename"]
-            file_type = os.path.splitext(file_path)[1][1:] if os.path.splitext(file_path)[1] else "unknown"
-            
-            try:
-                # 获取文件上下文
-                context = await self.scm.get_file_context(
-                    owner,
-                    repo,
-                    file_path,
-                    commit_diff.commit_id,
-                    1,
-                    window_size * 2
-                )
-                
-                if not context:
-                    logger.warning("No context returned for file: {} in commit: {}", file_path, commit_diff.commit_id[:8])
-                    continue
-                    
-                files_context.append({
-                    "file_path": file_path,
-                    "file_type": file_type,
-                    "context": context
-                })
-            except Exception as e:
+        semaphore = asyncio.Semaphore(self.config.scm.max_concurrency)
+
+        async def fetch_context(index: int, file_path: str) -> Tuple[int, str, Any]:
+            async with semaphore:
+                try:
+                    context = await self.scm.get_file_context(
+                        owner,
+                        repo,
+                        file_path,
+                        commit_diff.commit_id,
+                        1,
+                        window_size * 2
+                    )
+                except Exception as e:
+                    return index, file_path, e
+            return index, file_path, context
+
+        # 按完成顺序逐个处理，失败或空的上下文立即丢弃
+        collected = []
+        for next_done in asyncio.as_completed([
+            fetch_context(index, file["filename"]) for index, file in enumerate(filtered_files)
+        ]):
+            index, file_path, context = await next_done
+            if isinstance(context, Exception):
                 logger.error("Error getting context for file {} in commit {}: {}", 
-                             file_path, commit_diff.commit_id[:8], str(e))
+                             file_path, short_id, str(context))
                 continue
-                
+
+            if not context:
+                logger.warning("No context returned for file: {} in commit: {}", file_path, short_id)
+                continue
+
+            ext = os.path.splitext(file_path)[1]
+            file_type = ext[1:] if ext else "unknown"
+            collected.append((index, {
+                "file_path": file_path,
+                "file_type": file_type,
+                "context": context
+            }))
+
+        # 恢复原始文件顺序，保证prompt和缓存键稳定
+        collected.sort(key=lambda item: item[0])
+        files_context = [file_context for _, file_context in collected]
+
         if not files_context:
             logger.warning("No valid file contexts collected for commit {} (total files: {})", 
-                           commit_diff.commit_id[:8] if commit_diff and commit_diff.commit_id else "unknown", 
+                           short_id, 
                            len(commit_diff.files) if commit_diff and hasattr(commit_diff, 'files') else 0)
             return None
             
-        # 创建并验证上下文对象
-        try:
-            context = CodeContext(
-                diff=commit_diff.diff_content,
-                files_context=files_context,
-                metadata={
-                    "commit_id": commit_diff.commit_id,
-                    "commit_message": commit_diff.commit_message
-                }
-            )
-            return context
-        except Exception as e:
-            logger.error("Error creating CodeContext for commit {}: {}", 
-                         commit_diff.commit_id[:8] if commit_diff and commit_diff.commit_id else "unknown", 
-                         str(e))
-            return None
+        # 输入均已由CommitDiff校验并在此构造，跳过重复的pydantic校验
+        return CodeContext.model_construct(
+            diff=commit_diff.diff_content,
+            files_context=files_context,
+            metadata={
+                "commit_id": commit_diff.commit_id,
+                "commit_message": commit_diff.commit_message
+            }
+        )
 
-    async def _analyze_code(self, context: CodeContext) -> ReviewResult:
-        """分析整个commit的代码变更"""
+    async def _analyze_code(self, context: CodeContext) -> Optional[ReviewResult]:
+        """分析整个commit的代码变更，没有可评审的变更时返回None"""
+        meta = context.metadata
+        short_id = meta.get("commit_id", "unknown")[:8]
         logger.debug("Analyzing commit: {} - {} (files: {})",
-                    context.metadata["commit_id"][:8], 
-                    context.metadata["commit_message"].split('\n')[0][:50],
+                    short_id, 
+                    meta["commit_message"].split('\n')[0][:50],
                     len(context.files_context))
         
         try:
+            # 相同diff的重复评审由LLMService的chunk缓存处理，只缓存成功解析的结果
             result = await self.llm.analyze_code(context)
+            if result is None:
+                logger.info("No reviewable changes in commit {}", short_id)
+                return None
             
             # 记录评审结果
-            logger.info("Code analysis completed for commit {} with scores and {} files:",
-                       context.metadata["commit_id"][:8], len(context.files_context))
-            logger.info("- Overall Score: {}/10 (weight: {})", result.score, self.config.review.quality_threshold)
-            logger.info("- Security: {}/10 (weight: {})", result.quality_metrics.security_score, self.config.review.scoring_rules["security"])
-            logger.info("- Performance: {}/10 (weight: {})", result.quality_metrics.performance_score, self.config.review.scoring_rules["performance"])
-            logger.info("- Readability: {}/10 (weight: {})", result.quality_metrics.readability_score, self.config.review.scoring_rules["readability"])
-            logger.info("- Best Practices: {}/10 (weight: {})", result.quality_metrics.best_practice_score, self.config.review.scoring_rules["best_practice"])
-            
-            if result.security_issues:
-                logger.warning("Found {} security issues in commit {} (threshold: {})",
-                             len(result.security_issues), context.metadata["commit_id"][:8], self.config.review.max_security_issues)
+            review_config = self.config.review
+            rules = review_config.scoring_rules
+            metrics = result.quality_metrics
+            # 单条汇总日志；存在安全问题时提升为WARNING级别
+            logger.log("WARNING" if result.security_issues else "INFO",
+                       "Code analysis completed: commit={} files={} overall={}/10 (threshold={}) "
+                       "security={}/10 (weight={}) performance={}/10 (weight={}) "
+                       "readability={}/10 (weight={}) best_practice={}/10 (weight={}) "
+                       "security_issues={} (max={})",
+                       short_id, len(context.files_context),
+                       result.score, review_config.quality_threshold,
+                       metrics.security_score, rules["security"],
+                       metrics.performance_score, rules["performance"],
+                       metrics.readability_score, rules["readability"],
+                       metrics.best_practice_score, rules["best_practice"],
+                       len(result.security_issues), review_config.max_security_issues)
             
             return result
         except Exception as e:
-            logger.error("Error analyzing code for commit {}: {}\nFull error: {}", 
-                         context.metadata.get("commit_id", "unknown")[:8], 
-                         str(e), repr(e))
+            logger.error("Error analyzing code for commit {}: {!r}", 
+                         short_id, e)
             # 返回一个默认的评审结果
             return ReviewResult(
                 score=0,
@@ -138,66 +194,56 @@ class CodeReviewAgent:
 
     def _generate_comments(self, result: ReviewResult, context: CodeContext) -> List[ReviewComment]:
         """生成评审评论"""
+        meta = context.metadata
+        short_id = meta["commit_id"][:8]
         logger.debug("Generating comments for commit: {} with {} issues", 
-                     context.metadata["commit_id"][:8], len(result.issues))
+                     short_id, len(result.issues))
         comments = []
         
         # 添加总体评分评论
-        overall_comment = [
-            "# 🔍 代码评审报告",
-            "",
-            f"## 📊 评分概览 ({result.score:.1f}/10)",
-            "",
-            "| 评审维度 | 得分 | 权重 |",
-            "|---------|------|------|",
-            f"| 🛡️ 安全性 | {result.quality_metrics.security_score:.1f}/10 | {self.config.review.scoring_rules['security']:.0f} |",
-            f"| ⚡ 性能 | {result.quality_metrics.performance_score:.1f}/10 | {self.config.review.scoring_rules['performance']:.0f} |",
-            f"| 📖 可读性 | {result.quality_metrics.readability_score:.1f}/10 | {self.config.review.scoring_rules['readability']:.0f} |",
-            f"| ✨ 最佳实践 | {result.quality_metrics.best_practice_score:.1f}/10 | {self.config.review.scoring_rules['best_practice']:.0f} |",
-            ""
-        ]
-        
-        if result.issues:
-            overall_comment.extend([
-                "## 💡 需要改进的地方",
-                ""
-            ])
-            for issue in result.issues:
-                overall_comment.extend([
-                    f"### {issue.file_path}",
-                    f"- 位置：第{issue.start_line}行" + (f"-{issue.end_line}行" if issue.end_line else ""),
-                    f"- 问题：{issue.description}",
-                    f"- 建议：{issue.suggestion}",
-                    ""
-                ])
-        
-        if result.security_issues:
-            overall_comment.extend([
-                "## ⚠️ 安全问题",
-                ""
-            ])
-            for issue in result.security_issues:
-                severity_icon = "🔴" if issue.severity.lower() == "high" else "🟡"
-                overall_comment.extend([
-                    f"### {severity_icon} {issue.file_path}",
-                    f"- 严重程度：{issue.severity}",
-                    f"- 位置：第{issue.start_line}行" + (f"-{issue.end_line}行" if issue.end_line else ""),
-                    f"- 问题：{issue.description}",
-                    f"- 建议：{issue.suggestion}",
-                    ""
-                ])
+        body = _report_template.render(result=result, rules=self.config.review.scoring_rules)
         
         comments.append(ReviewComment(
-            path=context.metadata["commit_message"],
+            path=meta["commit_message"],
             line=1,
-            body="\n".join(overall_comment),
-            commit_id=context.metadata["commit_id"]
+            body=body,
+            commit_id=meta["commit_id"]
         ))
         
         logger.info("Generated {} review comments for commit {}", 
-                    len(comments), context.metadata["commit_id"][:8])
+                    len(comments), short_id)
         return comments
 
+    async def _review_commit(self, owner: str, repo: str, pr_id: str,
+                             commit_diff: CommitDiff) -> Optional[Tuple[ReviewResult, CodeContext, List[ReviewComment]]]:
+        """评审单个commit并生成评论，失败或无可评审文件时返回None"""
+        short_id = commit_diff.commit_id[:8]
+        try:
+            logger.info("Reviewing commit: {} - {} (files: {})",
+                       short_id,
+                       commit_diff.commit_message.split('\n')[0][:50],
+                       len(commit_diff.files))
+            
+            # 收集整个commit的上下文
+            context = await self._collect_context(owner, repo, commit_diff)
+            if not context:
+                logger.warning("Skipping commit {} due to no reviewable files (total files: {})",
+                             short_id, len(commit_diff.files))
+                return None
+            
+            # 分析整个commit的代码，LLM调用的并发上限由LLMService统一控制
+            result = await self._analyze_code(context)
+            if result is None:
+                return None
+            
+            # 生成评论，由review_pr统一发送
+            comments = self._generate_comments(result, context)
+            return result, context, comments
+        except Exception as commit_error:
+            logger.error("Error processing commit {} with {} files: {!r}",
+                        short_id, len(commit_diff.files), commit_error)
+            return None
+
     async def review_pr(self, owner: str, repo: str, pr_id: str) -> bool:
         """执行PR评审的主流程"""
         logger.info("Starting PR review for {}/{} #{}", 
@@ -208,55 +254,59 @@ class CodeReviewAgent:
             logger.info("Found {} commits to review in PR {}/{} #{}", 
                         len(commit_diffs), owner, repo, pr_id)
             
-            all_results = []
-            for commit_diff in commit_diffs:
-                try:
-                    logger.info("Reviewing commit: {} - {} (files: {})",
-                               commit_diff.commit_id[:8],
-                               commit_diff.commit_message.split('\n')[0][:50],
-                               len(commit_diff.files))
-                    
-                    # 收集整个commit的上下文
-                    context = await self._collect_context(owner, repo, commit_diff)
-                    if not context:
-                        logger.warning("Skipping commit {} due to no reviewable files (total files: {})",
-                                     commit_diff.commit_id[:8], len(commit_diff.files))
-                        continue
-                    
-                    # 分析整个commit的代码
-                    result = await self._analyze_code(context)
-                    all_results.append((result, context))
-                    
-                    # 生成并发送评论
-                    comments = self._generate_comments(result, context)
-                    
-                    await self.scm.post_comment(owner, repo, pr_id, comments)
-                    logger.info("Posted {} review comments for commit {}", 
-                                len(comments), commit_diff.commit_id[:8])
-                except Exception as commit_error:
-                    logger.error("Error processing commit {} with {} files: {}\nFull error: {}",
-                                commit_diff.commit_id[:8], len(commit_diff.files), str(commit_error), repr(commit_error))
+            # 各commit相互独立，并发评审；边完成边维护最低分
+            threshold = self.config.review.quality_threshold
+            tasks = [
+                asyncio.ensure_future(self._review_commit(owner, repo, pr_id, commit_diff))
+                for commit_diff in commit_diffs
+            ]
+            min_score = float("inf")
+            for next_done in asyncio.as_completed(tasks):
+                outcome = await next_done
+                if outcome is None:
                     continue
+                min_score = min(min_score, outcome[0].score)
+                if self.config.review.fail_fast and min_score < threshold:
+                    logger.info("Score {} below threshold {}, cancelling remaining commit reviews",
+                                min_score, threshold)
+                    for task in tasks:
+                        task.cancel()
+                    break
+            await asyncio.gather(*tasks, return_exceptions=True)
+            all_results = [
+                task.result() for task in tasks
+                if not task.cancelled() and task.exception() is None and task.result() is not None
+            ]
+            
+            # 所有commit的评论统一提交，由SCM按commit分组后并发创建评审
+            all_comments = [comment for _, _, comments in all_results for comment in comments]
+            if all_comments:
+                try:
+                    await self.scm.post_comment(owner, repo, pr_id, all_comments)
+                    logger.info("Posted {} review comments for {} commits in PR {}/{} #{}", 
+                                len(all_comments), len(all_results), owner, repo, pr_id)
+                except Exception as post_error:
+                    logger.error("Error posting {} review comments to PR {}/{} #{}: {}",
+                                 len(all_comments), owner, repo, pr_id, str(post_error))
             
             # 处理评审结果 - 使用最低分作为最终分数
             if all_results:
-                min_score = min(r.score for r, _ in all_results)
                 logger.info("PR review completed with minimum score: {} (threshold: {})", 
-                            min_score, self.config.review.quality_threshold)
-                if min_score >= self.config.review.quality_threshold:
+                            min_score, threshold)
+                if min_score >= threshold:
                     logger.info("PR quality meets threshold ({} >= {}), attempting to approve and merge",
-                               min_score, self.config.review.quality_threshold)
+                               min_score, threshold)
                     # 先批准PR
                     await self.scm.approve_pr(owner, repo, pr_id)
                     # 再合并PR
                     await self.scm.merge_pr(owner, repo, pr_id)
                 else:
                     logger.info("PR quality below threshold ({} < {}), skipping approval",
-                               min_score, self.config.review.quality_threshold)
+                               min_score, threshold)
             
             return True
             
         except Exception as e:
-            logger.error("Error reviewing PR {}/{} #{}: {}\nFull error: {}", 
-                         owner, repo, pr_id, str(e), repr(e))
+            logger.error("Error reviewing PR {}/{} #{}: {!r}", 
+                         owner, repo, pr_id, e)
             return False 
\ No newline at end of file
@@ -0,0 +1,113 @@
+from typing import List, Any, Optional, Tuple
+from functools import lru_cache
+from loguru import logger
+import fnmatch
+import re
+
+try:
+    import re2  # 可选依赖 google-re2，以DFA匹配大量忽略模式
+except ImportError:
+    re2 = None
+
+_GLOB_CHARS = frozenset("*?[")
+
+def _is_literal(text: str) -> bool:
+    """判断是否为不含通配符的非空字面量"""
+    return bool(text) and not _GLOB_CHARS.intersection(text)
+
+def _re2_escape(char: str) -> str:
+    return char if char.isalnum() or not char.isascii() else f"\\x{ord(char):02x}"
+
+def _glob_to_re2(pattern: str) -> str:
+    """将glob翻译为RE2兼容的正则（不含锚点，配合fullmatch使用），语义与fnmatch一致"""
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        char = pattern[i]
+        i += 1
+        if char == "*":
+            parts.append(".*")
+        elif char == "?":
+            parts.append(".")
+        elif char == "[":
+            j = i
+            if j < n and pattern[j] == "!":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j == -1:
+                parts.append(_re2_escape(char))
+                continue
+            body, i = pattern[i:j], j + 1
+            negate = body.startswith("!")
+            if negate:
+                body = body[1:]
+            items = []
+            k = 0
+            while k < len(body):
+                if k + 2 < len(body) and body[k + 1] == "-":
+                    if body[k] <= body[k + 2]:
+                        items.append(f"{_re2_escape(body[k])}-{_re2_escape(body[k + 2])}")
+                    k += 3
+                else:
+                    items.append(_re2_escape(body[k]))
+                    k += 1
+            if not items:
+                raise ValueError(f"Unsupported character class in pattern: {pattern}")
+            parts.append(("[^" if negate else "[") + "".join(items) + "]")
+        else:
+            parts.append(_re2_escape(char))
+    return "(?s:" + "".join(parts) + ")"
+
+def _compile_globs(patterns: List[str]) -> Optional[Any]:
+    """将glob列表编译为一个正则，优先使用re2，不可用或不兼容时回退到标准库re"""
+    if not patterns:
+        return None
+    if re2 is not None:
+        try:
+            return re2.compile("|".join(_glob_to_re2(p) for p in patterns))
+        except Exception as e:
+            logger.warning("Failed to compile ignore patterns with re2, falling back to re: {}", str(e))
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+class IgnoreMatcher:
+    """预编译的忽略模式匹配器，语义与逐个调用fnmatch一致"""
+    __slots__ = ("suffixes", "nested_suffixes", "literals", "regex")
+
+    def __init__(self, patterns: Tuple[str, ...]) -> None:
+        # 将忽略模式拆分为后缀元组/字面量集合，剩余的glob预编译为一个正则
+        # "*X" 与 "**/X" 等价于后缀匹配；"**/*X" 还要求后缀之前存在目录分隔符
+        suffixes, nested_suffixes, literals, globs = [], [], set(), []
+        for pattern in patterns:
+            if pattern.startswith("**/*") and _is_literal(pattern[4:]):
+                nested_suffixes.append(pattern[4:])
+            elif pattern.startswith("**/") and _is_literal(pattern[3:]):
+                suffixes.append(pattern[2:])
+            elif pattern.startswith("*") and _is_literal(pattern[1:]):
+                suffixes.append(pattern[1:])
+            elif _is_literal(pattern):
+                literals.add(pattern)
+            else:
+                globs.append(pattern)
+        self.suffixes = tuple(suffixes)
+        self.nested_suffixes = tuple(nested_suffixes)
+        self.literals = frozenset(literals)
+        self.regex = _compile_globs(globs)
+
+    def is_ignored(self, filename: str) -> bool:
+        if filename.endswith(self.suffixes):
+            return True
+        if filename.endswith(self.nested_suffixes) and any(
+            filename.endswith(suffix) and "/" in filename[:-len(suffix)]
+            for suffix in self.nested_suffixes
+        ):
+            return True
+        if filename in self.literals:
+            return True
+        return self.regex is not None and self.regex.fullmatch(filename) is not None
+
+@lru_cache(maxsize=16)
+def get_ignore_matcher(patterns: Tuple[str, ...]) -> IgnoreMatcher:
+    """按模式列表缓存匹配器，同一份配置只编译一次"""
+    return IgnoreMatcher(patterns)
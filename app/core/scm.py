@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from types import MappingProxyType
 from pydantic import BaseModel
 import aiohttp
+import asyncio
+import orjson
 from loguru import logger
 from app.models.config import GiteaConfig
 
@@ -39,48 +43,105 @@ class SCMProvider(ABC):
     async def get_file_context(self, owner: str, repo: str, file_path: str, commit_id: str, line_start: int, line_count: int) -> str:
         pass
 
+def _orjson_dumps(obj) -> str:
+    """使用orjson序列化请求体"""
+    return orjson.dumps(obj).decode("utf-8")
+
+def _slice_lines(content: str, start: int, end: int) -> List[str]:
+    """返回content的第[start, end)行，只扫描到第end行为止，不拆分整个文件"""
+    pos = 0
+    for _ in range(start):
+        newline = content.find("\n", pos)
+        if newline == -1:
+            return []
+        pos = newline + 1
+    stop = pos
+    for _ in range(end - start):
+        newline = content.find("\n", stop)
+        if newline == -1:
+            stop = len(content)
+            break
+        stop = newline + 1
+    return content[pos:stop].splitlines()[:end - start]
+
 class GiteaClient(SCMProvider):
     def __init__(self, config: GiteaConfig):
         self.config = config
-        self.headers = {
+        # 请求头只在创建会话时设置一次，之后只读
+        self.headers = MappingProxyType({
             "Authorization": f"token {config.token}",
-            "Content-Type": "application/json"
-        }
+            "Content-Type": "application/json",
+            # diff文本压缩率高，显式要求压缩传输，由aiohttp自动解压
+            "Accept-Encoding": "gzip, deflate"
+        })
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 同一commit下的文件内容不可变，按(owner, repo, file_path, commit_id)缓存原始内容
+        self._file_cache: "OrderedDict[Tuple[str, str, str, str], str]" = OrderedDict()
         logger.info("GiteaClient initialized with URL: {} and token length: {}", 
-                    config.url if config and hasattr(config, 'url') else "unknown", 
-                    len(config.token) if config and hasattr(config, 'token') and config.token else 0)
+                    config.url, len(config.token))
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享的会话，复用连接池避免每次请求重新握手"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=50, limit_per_host=20, keepalive_timeout=75),
+                json_serialize=_orjson_dumps
+            )
+        return self._session
+
+    async def aclose(self):
+        """关闭共享的会话"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def _make_request(self, method: str, path: str, **kwargs) -> dict:
         url = f"{self.config.url}/api/v1/{path}"
-        logger.debug("Making {} request to {} with params: {}", 
-                     method if method else "unknown", 
-                     url if url else "unknown", 
-                     kwargs if kwargs else "none")
+        logger.debug("Making {} request to {}", method, url)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.request(method, url, headers=self.headers, **kwargs) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-                    logger.debug("Request successful: {} {} with status code: {}", 
-                                 method if method else "unknown", 
-                                 url if url else "unknown", 
-                                 response.status if response and hasattr(response, 'status') else "unknown")
-                    return data
+            session = await self._get_session()
+            async with session.request(method, url, **kwargs) as response:
+                response.raise_for_status()
+                data = await response.json()
+                logger.debug("Request successful: {} {} with status code: {}", method, url, response.status)
+                return data
         except aiohttp.ClientError as e:
-            status = getattr(getattr(e, 'response', None), 'status', 'N/A')
             logger.error("Request failed: {} {} - Status: {} - Error: {}", 
-                         method if method else "unknown", 
-                         url if url else "unknown", 
-                         status if status else "N/A", 
-                         str(e))
+                         method, url, getattr(e, 'status', 'N/A'), str(e))
             raise
         except Exception as e:
-            logger.error("Unexpected error in request: {} {} - Error: {}", 
-                         method if method else "unknown", 
-                         url if url else "unknown", 
-                         str(e))
+            logger.error("Unexpected error in request: {} {} - Error: {}", method, url, str(e))
             raise
 
+    async def _get_diff_text(self, owner: str, repo: str, commit_id: str) -> str:
+        """获取commit的完整diff文本"""
+        session = await self._get_session()
+        url = f"{self.config.url}/api/v1/repos/{owner}/{repo}/git/commits/{commit_id}.diff"
+        async with session.get(url) as response:
+            response.raise_for_status()
+            # 直接按UTF-8解码原始字节，跳过text()的字符集探测
+            raw = await response.read()
+        return raw.decode("utf-8", "replace")
+
+    async def _fetch_commit(self, owner: str, repo: str, commit: dict, semaphore: asyncio.Semaphore) -> CommitDiff:
+        """同时获取单个commit的diff和变更文件列表"""
+        commit_id = commit["sha"]
+        async with semaphore:
+            diff_content, files = await asyncio.gather(
+                self._get_diff_text(owner, repo, commit_id),
+                self._make_request(
+                    "GET",
+                    f"repos/{owner}/{repo}/git/commits/{commit_id}"
+                )
+            )
+        return CommitDiff(
+            commit_id=commit_id,
+            commit_message=commit["commit"]["message"],
+            files=files.get("files", []),
+            diff_content=diff_content
+        )
+
     async def get_diff(self, owner: str, repo: str, pr_id: str) -> List[CommitDiff]:
         logger.info("Getting diff for PR {}/{} #{}", owner, repo, pr_id)
         try:
@@ -90,29 +151,11 @@ class GiteaClient(SCMProvider):
                 f"repos/{owner}/{repo}/pulls/{pr_id}/commits"
             )
             
-            diffs = []
-            for commit in commits:
-                commit_id = commit["sha"]
-                
-                # 获取这个commit的完整diff
-                async with aiohttp.ClientSession() as session:
-                    url = f"{self.config.url}/api/v1/repos/{owner}/{repo}/git/commits/{commit_id}.diff"
-                    async with session.get(url, headers=self.headers) as response:
-                        response.raise_for_status()
-                        diff_content = await response.text()
-                
-                # 获取这个commit变更的文件列表
-                files = await self._make_request(
-                    "GET",
-                    f"repos/{owner}/{repo}/git/commits/{commit_id}"
-                )
-                
-                diffs.append(CommitDiff(
-                    commit_id=commit_id,
-                    commit_message=commit["commit"]["message"],
-                    files=files.get("files", []),
-                    diff_content=diff_content
-                ))
+            # 并发获取各commit的diff和文件列表，用信号量限制并发请求数
+            semaphore = asyncio.Semaphore(self.config.max_concurrency)
+            diffs = await asyncio.gather(
+                *(self._fetch_commit(owner, repo, commit, semaphore) for commit in commits)
+            )
             
             logger.info("Found {} commits in PR {}/{} #{}", 
                        len(commits), owner, repo, pr_id)
@@ -122,47 +165,55 @@ class GiteaClient(SCMProvider):
                         owner, repo, pr_id, str(e))
             raise
 
+    async def _post_review_batch(self, owner: str, repo: str, pr_id: str, commit_id: str,
+                                 review_comments: List[dict], semaphore: asyncio.Semaphore):
+        """以一次评审提交一批评论"""
+        async with semaphore:
+            await self._make_request(
+                "POST",
+                f"repos/{owner}/{repo}/pulls/{pr_id}/reviews",
+                json={
+                    "commit_id": commit_id,
+                    "body": "Code Review Comments",
+                    "comments": review_comments,
+                    "event": "comment"
+                }
+            )
+
     async def post_comment(self, owner: str, repo: str, pr_id: str, comments: List[ReviewComment]):
-        logger.info("Posting {} comments to PR {}/{} #{} for commit: {}", 
-                    len(comments) if comments else 0, 
-                    owner if owner else "unknown", 
-                    repo if repo else "unknown", 
-                    pr_id if pr_id else "unknown", 
-                    comments[0].commit_id[:8] if comments and len(comments) > 0 and hasattr(comments[0], 'commit_id') else "unknown")
         if not comments:
             return
-            
-        review_comments = []
+        # Gitea的评审只能关联一个commit，按commit分组，每个commit单独提交评审
+        comments_by_commit: Dict[str, List[dict]] = {}
         for comment in comments:
-            review_comments.append({
+            comments_by_commit.setdefault(comment.commit_id, []).append({
                 "path": comment.path,
                 "body": comment.body,
                 "new_position": comment.line,
                 "commit_id": comment.commit_id
             })
+        logger.info("Posting {} comments to PR {}/{} #{} for {} commits: {}", 
+                    len(comments), owner, repo, pr_id, len(comments_by_commit),
+                    ", ".join(commit_id[:8] for commit_id in comments_by_commit))
             
+        # 评论较多时分批提交，避免单个请求体过大；所有commit的批次并发提交
+        batch_size = self.config.comment_batch_size
+        batches = [
+            (commit_id, review_comments[i:i + batch_size])
+            for commit_id, review_comments in comments_by_commit.items()
+            for i in range(0, len(review_comments), batch_size)
+        ]
+        semaphore = asyncio.Semaphore(self.config.max_concurrency)
         try:
-            await self._make_request(
-                "POST",
-                f"repos/{owner}/{repo}/pulls/{pr_id}/reviews",
-                json={
-                    "commit_id": comments[0].commit_id,
-                    "body": "Code Review Comments",
-                    "comments": review_comments,
-                    "event": "comment"
-                }
+            await asyncio.gather(
+                *(self._post_review_batch(owner, repo, pr_id, commit_id, batch, semaphore)
+                  for commit_id, batch in batches)
             )
-            logger.info("Successfully posted {} comments to PR {}/{} #{}", 
-                        len(comments) if comments else 0, 
-                        owner if owner else "unknown", 
-                        repo if repo else "unknown", 
-                        pr_id if pr_id else "unknown")
+            logger.info("Successfully posted {} comments in {} batches to PR {}/{} #{}", 
+                        len(comments), len(batches), owner, repo, pr_id)
         except Exception as e:
             logger.error("Failed to post comments to PR {}/{} #{}: {}", 
-                        owner if owner else "unknown", 
-                        repo if repo else "unknown", 
-                        pr_id if pr_id else "unknown", 
-                        str(e))
+                        owner, repo, pr_id, str(e))
             raise
 
     async def approve_pr(self, owner: str, repo: str, pr_id: str):
@@ -201,26 +252,39 @@ class GiteaClient(SCMProvider):
                         owner, repo, pr_id, str(e))
             raise
 
+    async def _get_file_content(self, owner: str, repo: str, file_path: str, commit_id: str) -> str:
+        """获取文件内容，命中缓存时不再请求Gitea"""
+        key = (owner, repo, file_path, commit_id)
+        content = self._file_cache.get(key)
+        if content is not None:
+            self._file_cache.move_to_end(key)
+            return content
+        
+        # 使用raw内容API直接获取文件内容
+        session = await self._get_session()
+        async with session.get(
+            f"{self.config.url}/api/v1/repos/{owner}/{repo}/raw/{file_path}?ref={commit_id}"
+        ) as response:
+            response.raise_for_status()
+            content = await response.text()
+        
+        if self.config.file_cache_size > 0:
+            self._file_cache[key] = content
+            while len(self._file_cache) > self.config.file_cache_size:
+                self._file_cache.popitem(last=False)
+        return content
+
     async def get_file_context(self, owner: str, repo: str, file_path: str, commit_id: str, line_start: int, line_count: int) -> str:
         logger.debug("Getting file context for {}/{} {} @ {} with lines: {}-{}", 
-                    owner, repo, file_path, commit_id[:8], line_start or 'start', line_count or 'end')
+                    owner, repo, file_path, commit_id[:8], line_start, line_count)
         try:
-            # 使用raw内容API直接获取文件内容
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"{self.config.url}/api/v1/repos/{owner}/{repo}/raw/{file_path}?ref={commit_id}",
-                    headers=self.headers
-                ) as response:
-                    response.raise_for_status()
-                    content = await response.text()
-                    
-            lines = content.splitlines()
+            content = await self._get_file_content(owner, repo, file_path, commit_id)
             start = max(0, line_start - line_count)
-            end = min(len(lines), line_start + line_count)
+            lines = _slice_lines(content, start, line_start + line_count)
             
-            context = "\n".join(lines[start:end])
+            context = "\n".join(lines)
             logger.debug("Got {} lines of context for {} (size: {} bytes)", 
-                        len(context.splitlines()), file_path, len(context))
+                        len(lines), file_path, len(context))
             return context
         except Exception as e:
             logger.error("Failed to get file context for {}: {}", 
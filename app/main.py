@@ -10,8 +10,13 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from app.routers import webhooks, config_ui
+from loguru import logger
 import uvicorn
 
+# 日志写入放到后台线程，避免阻塞事件循环
+logger.remove()
+logger.add(sys.stderr, enqueue=True)
+
 app = FastAPI(
     title="代码评审Agent",
     description="自动代码评审系统",
@@ -25,6 +30,16 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 app.include_router(webhooks.router, tags=["webhooks"])
 app.include_router(config_ui.router, tags=["config"])
 
+@app.on_event("startup")
+async def startup():
+    """初始化在多个PR之间共享的服务"""
+    webhooks.init_services(app)
+
+@app.on_event("shutdown")
+async def shutdown():
+    """释放SCM客户端的连接池"""
+    await webhooks.close_services(app)
+
 @app.get("/")
 async def root():
     """重定向到配置页面"""
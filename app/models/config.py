@@ -1,22 +1,30 @@
-from pydantic import BaseModel, Field, ConfigDict
-from typing import Dict, List, Optional
+from pydantic import BaseModel, Field, ConfigDict, PrivateAttr
+from typing import Any, Dict, List, Optional
+from app.core.ignore import IgnoreMatcher, get_ignore_matcher
 
 class GiteaConfig(BaseModel):
     model_config = ConfigDict(title="Gitea配置")
     url: str = Field(description="Gitea服务器URL")
     token: str = Field(description="Gitea API访问令牌")
     context_window: int = Field(10, description="代码上下文窗口大小")
+    max_concurrency: int = Field(16, ge=1, description="并发请求的最大数量")
+    file_cache_size: int = Field(256, ge=0, description="文件内容缓存条目数（0表示禁用）")
+    comment_batch_size: int = Field(50, ge=1, description="单次评审请求提交的最大评论数")
 
 class LLMConfig(BaseModel):
     model_config = ConfigDict(title="LLM配置")
     model: str = Field("deepseek/deepseek-chat", description="模型名称")
     api_key: str = Field(description="API密钥")
     max_tokens: int = Field(60000, description="最大token数")
+    max_concurrency: int = Field(4, ge=1, description="并发LLM请求的最大数量")
+    rpm: int = Field(0, ge=0, description="每分钟最大LLM请求数（0表示不限制）")
+    cache_size: int = Field(256, ge=0, description="评审结果缓存条目数（0表示禁用）")
 
 class ReviewConfig(BaseModel):
     model_config = ConfigDict(title="评审配置")
     quality_threshold: float = Field(8.5, description="质量阈值分数")
     max_security_issues: int = Field(5, description="最大安全问题数量")
+    fail_fast: bool = Field(False, description="评分低于阈值时停止评审剩余commit")
     ignore_patterns: List[str] = Field(
         default=[
             '**/node_modules/', '**/vendor/', '**/venv/', '**/.venv/',
@@ -48,6 +56,15 @@ class ReviewConfig(BaseModel):
         },
         description="评分规则权重"
     )
+    _ignore_matcher: IgnoreMatcher = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        # 加载配置时预编译忽略模式，配置缓存期间不再重复编译
+        self._ignore_matcher = get_ignore_matcher(tuple(self.ignore_patterns))
+
+    def is_ignored(self, path: str) -> bool:
+        """判断文件是否匹配任一忽略模式"""
+        return self._ignore_matcher.is_ignored(path)
 
 class AppConfig(BaseModel):
     model_config = ConfigDict(title="应用配置")
@@ -1,23 +1,44 @@
 from fastapi import APIRouter, Request, Form
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 import yaml
+try:
+    # 优先使用libyaml的C实现
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 from app.models.config import AppConfig, GiteaConfig, LLMConfig, ReviewConfig
 
 router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
+# 编译后的模板字节码缓存到临时目录，重启后无需重新解析模板
+templates.env.bytecode_cache = FileSystemBytecodeCache()
 
 CONFIG_FILE = "config.yaml"
 
+# 已解析的配置及对应文件的mtime（文件不存在时为None），文件未变化时直接复用
+_config_cache: Optional[Tuple[Optional[int], AppConfig]] = None
+
 def load_config() -> AppConfig:
     """加载配置文件"""
-    if Path(CONFIG_FILE).exists():
+    global _config_cache
+    config_path = Path(CONFIG_FILE)
+    if config_path.exists():
+        mtime_ns = config_path.stat().st_mtime_ns
+        if _config_cache is not None and _config_cache[0] == mtime_ns:
+            return _config_cache[1]
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            config_data = yaml.safe_load(f)
-            return AppConfig.parse_obj(config_data)
-    return AppConfig(
+            config_data = yaml.load(f, Loader=SafeLoader)
+            config = AppConfig.model_validate(config_data)
+        _config_cache = (mtime_ns, config)
+        return config
+    # 没有配置文件时复用同一个默认配置，避免调用方误以为配置发生了变化
+    if _config_cache is not None and _config_cache[0] is None:
+        return _config_cache[1]
+    config = AppConfig(
         scm=GiteaConfig(
             url="",
             token="",
@@ -30,12 +51,17 @@ def load_config() -> AppConfig:
         ),
         review=ReviewConfig()  # 使用config.py中的默认值
     )
+    _config_cache = (None, config)
+    return config
 
 def save_config(config: AppConfig):
     """保存配置文件"""
-    config_dict = config.dict()
+    global _config_cache
+    config_dict = config.model_dump(mode="python")
     with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        yaml.safe_dump(config_dict, f, allow_unicode=True)
+        yaml.dump(config_dict, f, Dumper=SafeDumper, allow_unicode=True)
+    # 直接更新缓存，下次加载无需重新解析
+    _config_cache = (Path(CONFIG_FILE).stat().st_mtime_ns, config)
 
 @router.get("/config", response_class=HTMLResponse)
 async def get_config(request: Request):
@@ -52,10 +78,18 @@ async def save_config_handler(
     scm_url: str = Form(alias="scm.url"),
     scm_token: str = Form(alias="scm.token"),
     scm_context_window: int = Form(alias="scm.context_window"),
+    scm_max_concurrency: int = Form(alias="scm.max_concurrency"),
+    scm_file_cache_size: int = Form(alias="scm.file_cache_size"),
+    scm_comment_batch_size: int = Form(alias="scm.comment_batch_size"),
     llm_model: str = Form(alias="llm.model"),
     llm_api_key: str = Form(alias="llm.api_key"),
     llm_max_tokens: int = Form(alias="llm.max_tokens"),
+    llm_max_concurrency: int = Form(alias="llm.max_concurrency"),
+    llm_rpm: int = Form(alias="llm.rpm"),
+    llm_cache_size: int = Form(alias="llm.cache_size"),
     review_quality_threshold: float = Form(alias="review.quality_threshold"),
+    # 未勾选的checkbox不会随表单提交
+    review_fail_fast: bool = Form(False, alias="review.fail_fast"),
     review_ignore_patterns: str = Form(alias="review.ignore_patterns"),
     review_scoring_rules_security: float = Form(alias="review.scoring_rules.security"),
     review_scoring_rules_performance: float = Form(alias="review.scoring_rules.performance"),
@@ -63,28 +97,38 @@ async def save_config_handler(
     review_scoring_rules_best_practice: float = Form(alias="review.scoring_rules.best_practice")
 ):
     """保存配置"""
-    config = AppConfig(
-        scm=GiteaConfig(
-            url=scm_url,
-            token=scm_token,
-            context_window=scm_context_window
-        ),
-        llm=LLMConfig(
-            model=llm_model,
-            api_key=llm_api_key,
-            max_tokens=llm_max_tokens
-        ),
-        review=ReviewConfig(
-            quality_threshold=review_quality_threshold,
-            ignore_patterns=[p.strip() for p in review_ignore_patterns.split("\n") if p.strip()],
-            scoring_rules={
-                "security": review_scoring_rules_security,
-                "performance": review_scoring_rules_performance,
-                "readability": review_scoring_rules_readability,
-                "best_practice": review_scoring_rules_best_practice
-            }
-        )
-    )
+    # 表单的值覆盖到当前配置上，表单中没有的字段保留原值
+    current = load_config().model_dump(mode="python")
+    current["scm"].update({
+        "url": scm_url,
+        "token": scm_token,
+        "context_window": scm_context_window,
+        "max_concurrency": scm_max_concurrency,
+        "file_cache_size": scm_file_cache_size,
+        "comment_batch_size": scm_comment_batch_size
+    })
+    current["llm"].update({
+        "model": llm_model,
+        "api_key": llm_api_key,
+        "max_tokens": llm_max_tokens,
+        "max_concurrency": llm_max_concurrency,
+        "rpm": llm_rpm,
+        "cache_size": llm_cache_size
+    })
+    current["review"].update({
+        "quality_threshold": review_quality_threshold,
+        "fail_fast": review_fail_fast,
+        "ignore_patterns": [p.strip() for p in review_ignore_patterns.split("\n") if p.strip()],
+        "scoring_rules": {
+            **current["review"]["scoring_rules"],
+            "security": review_scoring_rules_security,
+            "performance": review_scoring_rules_performance,
+            "readability": review_scoring_rules_readability,
+            "best_practice": review_scoring_rules_best_practice
+        }
+    })
+    # 一次性校验整个嵌套结构，不逐个构造子模型
+    config = AppConfig.model_validate(current)
     
     save_config(config)
     
@@ -1,15 +1,19 @@
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi import APIRouter, BackgroundTasks, HTTPException, FastAPI, Request
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Set, Tuple
 from app.core.agent import CodeReviewAgent
 from app.core.scm import GiteaClient
 from app.services.llm_service import LLMService
 from app.models.config import AppConfig
 from app.routers.config_ui import load_config
-import logging
+from loguru import logger
 
 router = APIRouter()
 
+# 正在评审的PR，以及评审期间又收到事件、需要再评审一次的PR
+_running_prs: Set[Tuple[str, str, str]] = set()
+_dirty_prs: Set[Tuple[str, str, str]] = set()
+
 class PRWebhook(BaseModel):
     action: str
     number: int
@@ -17,46 +21,112 @@ class PRWebhook(BaseModel):
     repository: Dict[str, Any]
     sender: Dict[str, Any]
 
-async def process_pr(owner: str, repo: str, pr_id: str):
-    """处理PR的后台任务"""
-    try:
-        # 加载配置
-        config = load_config()
-        
-        # 初始化服务
+def init_services(app: FastAPI) -> None:
+    """应用启动时初始化共享服务的占位，首次处理PR时再创建
+
+    未配置API key时也要能启动，以便通过配置页面完成配置
+    """
+    app.state.config = None
+    app.state.scm = None
+    app.state.agent = None
+    # 每个SCM客户端上进行中的评审数，配置变化后旧客户端在评审全部结束时关闭
+    app.state.scm_users = {}
+
+async def close_services(app: FastAPI) -> None:
+    """应用关闭时释放所有SCM客户端的连接"""
+    for scm in {*app.state.scm_users, app.state.scm}:
+        if scm is not None:
+            await scm.aclose()
+    app.state.scm_users = {}
+
+async def get_agent(app: FastAPI) -> CodeReviewAgent:
+    """获取共享的评审Agent，连接池在多个PR之间复用，配置变化时重新创建"""
+    config = load_config()
+    if config is not app.state.config:
+        old_agent = app.state.agent
+        # LLM配置未变化时复用原服务，保留其chunk缓存
+        reuse_llm = old_agent is not None and config.llm == app.state.config.llm
+        # 新服务全部创建成功后再替换，创建失败时保留当前的客户端
+        llm = old_agent.llm if reuse_llm else LLMService(config.llm)
         scm = GiteaClient(config.scm)
-        llm = LLMService(config.llm)
-        agent = CodeReviewAgent(config, scm, llm)
-        
-        # 执行评审
-        await agent.review_pr(owner, repo, pr_id)
-    except Exception as e:
-        logger.error("Error processing PR {}/{} #{}: {}", 
-                    owner if owner else "unknown", 
-                    repo if repo else "unknown", 
-                    pr_id if pr_id else "unknown", 
-                    str(e))
+        old_scm = app.state.scm
+        app.state.agent = CodeReviewAgent(config, scm, llm)
+        app.state.scm = scm
+        app.state.config = config
+        if old_agent is not None and not reuse_llm:
+            # 旧Router的全局回调不移除会一直被后续的LLM调用执行，且无法释放
+            old_agent.llm.close()
+        # 旧客户端没有进行中的评审时立即关闭，否则由最后一个评审结束时关闭
+        if old_scm is not None and old_scm not in app.state.scm_users:
+            await old_scm.aclose()
+    return app.state.agent
+
+async def _release_scm(app: FastAPI, scm: GiteaClient) -> None:
+    """评审结束时释放对SCM客户端的引用，已被替换的客户端在最后一个评审结束后关闭"""
+    scm_users = app.state.scm_users
+    remaining = scm_users[scm] - 1
+    if remaining:
+        scm_users[scm] = remaining
+        return
+    del scm_users[scm]
+    if scm is not app.state.scm:
+        await scm.aclose()
+
+async def process_pr(app: FastAPI, owner: str, repo: str, pr_id: str):
+    """处理PR的后台任务
+
+    同一PR的评审不会并发执行：评审进行中收到的事件只做标记，
+    当前评审结束后再合并评审一次，连续推送不会重复消耗LLM调用
+    """
+    key = (owner, repo, pr_id)
+    if key in _running_prs:
+        _dirty_prs.add(key)
+        logger.info("PR {}/{} #{} review in progress, queued a re-run", owner, repo, pr_id)
+        return
+
+    _running_prs.add(key)
+    try:
+        while True:
+            _dirty_prs.discard(key)
+            try:
+                # 执行评审，评审期间持有SCM客户端的引用，避免配置变化时被关闭
+                agent = await get_agent(app)
+                scm_users = app.state.scm_users
+                scm_users[agent.scm] = scm_users.get(agent.scm, 0) + 1
+                try:
+                    await agent.review_pr(owner, repo, pr_id)
+                finally:
+                    await _release_scm(app, agent.scm)
+            except Exception as e:
+                logger.error("Error processing PR {}/{} #{}: {!r}", owner, repo, pr_id, e)
+            if key not in _dirty_prs:
+                break
+    finally:
+        _running_prs.discard(key)
+        _dirty_prs.discard(key)
 
 @router.post("/webhook/gitea")
 async def handle_webhook(
     webhook: PRWebhook,
-    background_tasks: BackgroundTasks
+    background_tasks: BackgroundTasks,
+    request: Request
 ):
     """处理Gitea webhook"""
     # 只处理PR相关事件
     if webhook.action not in ["opened", "reopened", "synchronize"]:
         return {"status": "ignored"}
-    
+
     # 从仓库信息中获取owner和repo
     owner = webhook.repository["owner"]["username"]
     repo = webhook.repository["name"]
-    
+
     # 添加后台任务
     background_tasks.add_task(
         process_pr,
+        request.app,
         owner,
         repo,
         str(webhook.number)
     )
-    
-    return {"status": "processing"} 
\ No newline at end of file
+
+    return {"status": "processing"}
\ No newline at end of file
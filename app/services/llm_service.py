@@ -1,11 +1,42 @@
-from typing import List, Dict, Optional
+from typing import Iterable, List, Dict, Optional, Tuple
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import cached_property, lru_cache
+from string import Formatter
+import asyncio
+import hashlib
+import json
+import math
+import re
+import orjson
 import tiktoken
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 import litellm
 from loguru import logger
 from app.models.config import LLMConfig, ReviewConfig
 
+# 每个文件diff的起始行
+_DIFF_HEADER_RE = re.compile(r'^diff --git ', re.M)
+# 从diff头部行（diff --git a/... b/...）中提取文件路径
+_FILE_PATH_RE = re.compile(r'a/(.*?) b/')
+# 含有非空白内容的增删行，只在hunk内容中搜索，hunk中的"--- "/"+++ "也是正常的增删行
+_CHANGED_LINE_RE = re.compile(r'^[+-][ \t]*\S', re.M)
+# LLM响应中markdown代码块包裹的JSON对象
+_JSON_FENCE_RE = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.S)
+
+def _finite_float(value: str) -> float:
+    """解析JSON中的浮点数，拒绝NaN/Infinity，避免污染最低分的计算"""
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"Non-finite number in JSON: {value}")
+    return number
+
+# 增量解析JSON，只读到对象结束；允许字符串中出现未转义的换行
+_JSON_DECODER = json.JSONDecoder(strict=False, parse_float=_finite_float, parse_constant=_finite_float)
+
 class CodeIssue(BaseModel):
+    # 评审问题生成后只读，合并结果时可直接共享实例
+    model_config = ConfigDict(frozen=True, extra="ignore")
     file_path: str
     start_line: int
     end_line: Optional[int]
@@ -13,6 +44,7 @@ class CodeIssue(BaseModel):
     suggestion: str
 
 class SecurityIssue(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
     severity: str
     file_path: str
     start_line: int
@@ -21,16 +53,16 @@ class SecurityIssue(BaseModel):
     suggestion: str
 
 class QualityMetrics(BaseModel):
-    security_score: float
-    performance_score: float
-    readability_score: float
-    best_practice_score: float
+    security_score: float = 0.0
+    performance_score: float = 0.0
+    readability_score: float = 0.0
+    best_practice_score: float = 0.0
 
 class ReviewResult(BaseModel):
-    score: float
-    issues: List[CodeIssue]
-    security_issues: List[SecurityIssue]
-    quality_metrics: QualityMetrics
+    score: float = 0.0
+    issues: List[CodeIssue] = Field(default_factory=list)
+    security_issues: List[SecurityIssue] = Field(default_factory=list)
+    quality_metrics: QualityMetrics = Field(default_factory=QualityMetrics)
 
 class CodeContext(BaseModel):
     diff: str  # commit 的完整 diff 内容
@@ -41,7 +73,19 @@ class CodeContext(BaseModel):
         """返回文件上下文的数量"""
         return len(self.files_context)
 
-REVIEW_PROMPT = """你是一个专业的代码评审专家，请根据以下代码变更内容进行评审。评审时请特别注意以下几点：
+    def cache_key(self, model: str) -> str:
+        """根据模型、diff内容和文件列表计算评审结果的缓存键"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(model.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(self.diff.encode("utf-8"))
+        for f in self.files_context:
+            digest.update(b"\0")
+            digest.update(f["file_path"].encode("utf-8"))
+        return digest.hexdigest()
+
+# 评审规则和输出格式不随commit变化，放在system消息中，便于服务商缓存相同的前缀
+REVIEW_SYSTEM_PROMPT = """你是一个专业的代码评审专家，请根据用户提供的代码变更内容进行评审。评审时请特别注意以下几点：
 
 1. 安全性（占比30%）：
    - 检查SQL注入、XSS等安全漏洞
@@ -70,15 +114,6 @@ REVIEW_PROMPT = """你是一个专业的代码评审专家，请根据以下代
 - 可读性问题：-0.5分/个
 - 最佳实践：缺少单元测试-2分，无类型提示-1分
 
-Commit信息：
-{commit_message}
-
-代码变更：
-{diff}
-
-相关文件上下文：
-{files_context}
-
 请提供详细的评审结果，包括：
 1. 总体评分（满分10分）
 2. 具体问题列表（包含文件路径和代码位置）
@@ -86,34 +121,34 @@ Commit信息：
 4. 各维度的具体评分
 
 请以JSON格式返回结果，格式如下：
-{{
+{
     "score": float,
     "issues": [
-        {{
+        {
             "file_path": string,
             "start_line": int,
             "end_line": int | null,
             "description": string,
             "suggestion": string
-        }}
+        }
     ],
     "security_issues": [
-        {{
+        {
             "severity": string,
             "file_path": string,
             "start_line": int,
             "end_line": int | null,
             "description": string,
             "suggestion": string
-        }}
+        }
     ],
-    "quality_metrics": {{
+    "quality_metrics": {
         "security_score": float,
         "performance_score": float,
         "readability_score": float,
         "best_practice_score": float
-    }}
-}}
+    }
+}
 
 注意：
 1. 每个问题必须指明具体的文件路径和代码位置（行号）
@@ -122,6 +157,174 @@ Commit信息：
 4. 所有的行号必须是实际的代码行号
 """
 
+# 每个chunk变化的部分
+REVIEW_USER_PROMPT = """Commit信息：
+{commit_message}
+
+代码变更：
+{diff}
+
+相关文件上下文：
+{files_context}
+"""
+
+def _split_prompt(template: str) -> Tuple[str, ...]:
+    """按占位符切分模板为字面量片段（已处理{{和}}转义），并校验占位符顺序"""
+    parts, literal, fields = [], [], []
+    for text, field, _, _ in Formatter().parse(template):
+        literal.append(text)
+        if field is not None:
+            parts.append("".join(literal))
+            literal = []
+            fields.append(field)
+    parts.append("".join(literal))
+    if fields != ["commit_message", "diff", "files_context"]:
+        raise ValueError(f"Unexpected prompt placeholders: {fields}")
+    return tuple(parts)
+
+# 模块加载时切分一次，构造prompt时直接拼接，不再逐chunk解析格式串
+_PROMPT_PARTS = _split_prompt(REVIEW_USER_PROMPT)
+
+# 静态的system消息标记为可缓存：Anthropic等按cache_control缓存前缀，OpenAI类服务商自动缓存，该标记不影响请求
+_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [{"type": "text", "text": REVIEW_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+}
+
+def _build_prompt(commit_message: str, diff: str, files_context: str) -> str:
+    p0, p1, p2, p3 = _PROMPT_PARTS
+    return "".join((p0, commit_message, p1, diff, p2, files_context, p3))
+
+@lru_cache(maxsize=8)
+def _get_tokenizer(model_name: str) -> tiktoken.Encoding:
+    """按模型名缓存tokenizer，多个LLMService实例共享同一个编码器"""
+    return tiktoken.encoding_for_model(model_name)
+
+def _try_loads(json_text: str) -> object:
+    """解析JSON文本，允许字符串中出现未转义的换行，失败时返回None"""
+    try:
+        return orjson.loads(json_text)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        return _JSON_DECODER.decode(json_text)
+    except ValueError:
+        return None
+
+def _has_score(json_obj: object) -> bool:
+    """是否为包含评分的评审结果，用于排除响应中顺带出现的其他JSON对象"""
+    return isinstance(json_obj, dict) and "score" in json_obj
+
+def _extract_json(response_text: str, json_start: int) -> object:
+    """从LLM响应中解析JSON对象
+
+    依次尝试：整个响应就是JSON、markdown代码块中的JSON、从第一个{开始增量解析到对象结束，
+    只采用包含score的对象；都不满足时取第一个{到最后一个}之间的内容
+    """
+    if json_start == 0 and response_text.endswith("}"):
+        json_obj = _try_loads(response_text)
+        if _has_score(json_obj):
+            return json_obj
+
+    fence_match = _JSON_FENCE_RE.search(response_text)
+    if fence_match:
+        json_obj = _try_loads(fence_match.group(1))
+        if _has_score(json_obj):
+            return json_obj
+
+    try:
+        json_obj = _JSON_DECODER.raw_decode(response_text, json_start)[0]
+    except ValueError:
+        json_obj = None
+    if _has_score(json_obj):
+        return json_obj
+
+    json_text = response_text[json_start:response_text.rfind("}") + 1]
+    # 先直接解析JSON，失败时再清理字符串中未转义的换行后重试，仍失败则抛出解析错误
+    try:
+        return orjson.loads(json_text)
+    except orjson.JSONDecodeError:
+        return orjson.loads(json_text.replace('\n', ' ').replace('\r', ''))
+
+def _cached_tokens(response) -> int:
+    """返回响应中命中服务商prompt缓存的token数，服务商未返回时为0"""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+def _has_reviewable_changes(diff: str) -> bool:
+    """diff中是否有含非空白内容的增删行，没有这类行的diff（如二进制文件）无需评审
+
+    只检查每个文件第一个@@之后的hunk内容，文件头中的---/+++不计入
+    """
+    starts = [m.start() for m in _DIFF_HEADER_RE.finditer(diff)] or [0]
+    for start, end in zip(starts, starts[1:] + [len(diff)]):
+        hunk_start = diff.find("\n@@", start, end)
+        if hunk_start != -1 and _CHANGED_LINE_RE.search(diff, hunk_start, end):
+            return True
+    return False
+
+def _dedupe_contexts(files_context: Iterable[dict]) -> List[dict]:
+    """同一个chunk中内容完全相同的文件只发送一次，其余引用该chunk中的首个文件"""
+    seen_contexts: Dict[str, str] = {}
+    deduped = []
+    for f in files_context:
+        first_path = seen_contexts.setdefault(f["context"], f["file_path"])
+        if first_path != f["file_path"]:
+            # 文件上下文在多个chunk之间共享，替换时复制而不修改原对象
+            f = {**f, "context": f"（内容与 {first_path} 相同）"}
+        deduped.append(f)
+    return deduped
+
+def _merge_results(results: List[ReviewResult]) -> ReviewResult:
+    """合并多个chunk的评审结果"""
+    # 使用最低分作为最终分数，一次遍历同时合并问题列表和各维度最低分
+    score = security_score = performance_score = readability_score = best_practice_score = float("inf")
+    issues: List[CodeIssue] = []
+    security_issues: List[SecurityIssue] = []
+    for r in results:
+        metrics = r.quality_metrics
+        score = min(score, r.score)
+        security_score = min(security_score, metrics.security_score)
+        performance_score = min(performance_score, metrics.performance_score)
+        readability_score = min(readability_score, metrics.readability_score)
+        best_practice_score = min(best_practice_score, metrics.best_practice_score)
+        issues.extend(r.issues)
+        security_issues.extend(r.security_issues)
+    return ReviewResult(
+        score=score,
+        issues=issues,
+        security_issues=security_issues,
+        quality_metrics=QualityMetrics(
+            security_score=security_score,
+            performance_score=performance_score,
+            readability_score=readability_score,
+            best_practice_score=best_practice_score
+        )
+    )
+
+class _RateLimiter:
+    """按每分钟请求数限流的令牌桶，允许短时突发到rpm个请求"""
+
+    def __init__(self, rpm: int):
+        self._capacity = float(rpm)
+        self._rate = rpm / 60.0
+        self._tokens = float(rpm)
+        self._updated: Optional[float] = None
+
+    async def __aenter__(self):
+        now = asyncio.get_running_loop().time()
+        if self._updated is not None:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        # 先预占令牌再等待，并发调用各自排到后续的时间点
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
 class LLMService:
     def __init__(self, config: LLMConfig):
         self.config = config
@@ -134,300 +337,285 @@ class LLMService:
             raise ValueError("API key is required")
             
         logger.info("Setting up LLMService with model: {} and max_tokens: {}", 
-                    self.model_name if hasattr(self, 'model_name') else "unknown", 
-                    self.config.max_tokens if hasattr(self, 'config') and hasattr(self.config, 'max_tokens') else 0)
-        litellm.api_key = self.api_key
+                    self.model_name, 
+                    self.config.max_tokens)
+        # 每个服务实例持有独立的Router，API key随请求传递而不修改litellm的全局状态，
+        # 并由Router复用底层HTTP客户端、在失败时重试
+        deployment = {
+            "model_name": self.model_name,
+            "litellm_params": {"model": self.model_name, "api_key": self.api_key}
+        }
+        if config.rpm > 0:
+            deployment["rpm"] = config.rpm
+        self.router = litellm.Router(model_list=[deployment], num_retries=2)
+        # 所有LLM请求共享的并发上限和每分钟请求数限制，避免触发服务商的429
+        self._semaphore = asyncio.Semaphore(config.max_concurrency)
+        self._rate_limiter = _RateLimiter(config.rpm) if config.rpm > 0 else nullcontext()
+        # chunk级的评审结果缓存（LRU），相同的chunk在重试、rebase或其他commit中出现时无需再次调用LLM；
+        # 只缓存成功解析的结果，解析失败的chunk下次评审时会重新请求
+        self._chunk_cache: "OrderedDict[str, ReviewResult]" = OrderedDict()
         litellm.set_verbose = False
-        
+            
+        logger.info("LLMService initialized successfully with model: {} and chunk_size: {}", 
+                    self.model_name, 
+                    self.config.max_tokens)
+
+    def close(self) -> None:
+        """服务不再使用时调用，移除Router注册在litellm全局回调列表中的自身"""
+        self.router.discard()
+
+    @cached_property
+    def tokenizer(self) -> tiktoken.Encoding:
+        """分词器只在diff可能超出token预算时才用到，首次使用时再加载"""
         try:
-            self.tokenizer = tiktoken.encoding_for_model("gpt-4")
+            tokenizer = _get_tokenizer("gpt-4")
             logger.info("Tokenizer initialized successfully for model: {}", 
-                        self.model_name if hasattr(self, 'model_name') else "unknown")
+                        self.model_name)
+            return tokenizer
         except Exception as e:
             logger.error("Error initializing tokenizer for model {}: {}", 
-                         self.model_name if hasattr(self, 'model_name') else "unknown", 
+                         self.model_name, 
                          str(e))
             raise
-            
-        logger.info("LLMService initialized successfully with model: {} and chunk_size: {}", 
-                    self.model_name if hasattr(self, 'model_name') else "unknown", 
-                    self.config.max_tokens if hasattr(self, 'config') and hasattr(self.config, 'max_tokens') else 0)
     
     def _split_code_chunks(self, context: CodeContext) -> List[CodeContext]:
         max_tokens = self.config.max_tokens - 1000  # 预留空间给prompt和response
-        
-        def count_tokens(text: str) -> int:
-            return len(self.tokenizer.encode(text))
 
         chunks = []
-        current_chunk = CodeContext(
-            diff="",
-            files_context=[],
-            metadata=context.metadata
-        )
-        current_tokens = 0
-        
-        # 按文件分割diff内容
         diff_content = context.diff
-        file_diffs = diff_content.split("diff --git ")
-        if file_diffs[0] == "":  # 移除空的第一个元素
-            file_diffs = file_diffs[1:]
-            
-        current_files = []  # 当前chunk包含的文件路径
-        
-        for file_diff in file_diffs:
-            if not file_diff:
-                continue
-                
-            file_diff = "diff --git " + file_diff
-            file_tokens = count_tokens(file_diff)
-            
-            # 从diff中提取文件路径
-            import re
-            file_path_match = re.search(r'a/(.*?) b/', file_diff)
-            if not file_path_match:
-                continue
-            file_path = file_path_match.group(1)
-            
-            if current_tokens + file_tokens > max_tokens and current_chunk.diff:
+
+        # 按文件分割diff内容，只记录每个文件diff在原文中的起止位置
+        starts = [m.start() for m in _DIFF_HEADER_RE.finditer(diff_content)]
+        spans = list(zip(starts, starts[1:] + [len(diff_content)]))
+        file_diffs = [diff_content[start:end] for start, end in spans]
+        # BPE的每个token至少对应1个字节，diff总字节数不超过预算时必然只有一个chunk，无需分词
+        diff_bytes = len(diff_content) if diff_content.isascii() else len(diff_content.encode("utf-8"))
+        if diff_bytes <= max_tokens:
+            token_counts = [0] * len(file_diffs)
+        else:
+            # 所有文件diff一次批量计算token数，减少进入tiktoken的调用次数
+            token_counts = [len(tokens) for tokens in self.tokenizer.encode_ordinary_batch(file_diffs)]
+
+        # 按文件路径索引文件上下文，生成chunk时直接查找
+        files_by_path: Dict[str, List[dict]] = {}
+        for f in context.files_context:
+            files_by_path.setdefault(f["file_path"], []).append(f)
+
+        # 提取每个文件diff的路径，无法识别路径的diff跳过
+        items = []  # (起始位置, 结束位置, 文件路径, token数)，保持原始顺序
+        for (start, end), file_diff, file_tokens in zip(spans, file_diffs, token_counts):
+            # 从diff头部行中提取文件路径，只搜索第一行
+            header_end = file_diff.find("\n")
+            file_path_match = _FILE_PATH_RE.search(file_diff, 0, header_end if header_end != -1 else len(file_diff))
+            if file_path_match:
+                items.append((start, end, file_path_match.group(1), file_tokens))
+
+        # 首次适应递减装箱：按token数从大到小放入第一个放得下的chunk，减少chunk数量（即LLM调用次数）
+        # 单个超出预算的文件独占一个chunk
+        bins = []  # [剩余token数, 原始顺序下标列表]
+        for index in sorted(range(len(items)), key=lambda i: -items[i][3]):
+            file_tokens = items[index][3]
+            for chunk_bin in bins:
+                if chunk_bin[0] >= file_tokens:
+                    chunk_bin[0] -= file_tokens
+                    chunk_bin[1].append(index)
+                    break
+            else:
+                bins.append([max_tokens - file_tokens, [index]])
+
+        # chunk内的文件恢复原始顺序，chunk之间按首个文件的位置排序，保持diff的连续性
+        for _, indices in sorted(bins, key=lambda chunk_bin: min(chunk_bin[1])):
+            indices.sort()
+            chunk_spans = []  # 当前chunk包含的diff区间，相邻区间合并为一段
+            chunk_files = {}  # 当前chunk包含的文件路径（有序去重）
+            for index in indices:
+                start, end, file_path, _ = items[index]
+                if chunk_spans and chunk_spans[-1][1] == start:
+                    chunk_spans[-1] = (chunk_spans[-1][0], end)
+                else:
+                    chunk_spans.append((start, end))
+                chunk_files[file_path] = None
+            # 每个chunk的diff只在生成时切片拼接一次
+            # 字段均取自已校验的context，跳过重复的pydantic校验
+            chunks.append(CodeContext.model_construct(
+                diff="".join(diff_content[start:end] for start, end in chunk_spans),
                 # 添加相关的文件上下文
-                current_chunk.files_context = [
-                    f for f in context.files_context 
-                    if f["file_path"] in current_files
-                ]
-                chunks.append(current_chunk)
-                
-                # 重置当前chunk
-                current_chunk = CodeContext(
-                    diff="",
-                    files_context=[],
-                    metadata=context.metadata
-                )
-                current_tokens = 0
-                current_files = []
-            
-            # 添加文件diff到当前chunk
-            current_chunk.diff += file_diff
-            current_tokens += file_tokens
-            current_files.append(file_path)
-        
-        # 处理最后一个chunk
-        if current_chunk.diff:
-            current_chunk.files_context = [
-                f for f in context.files_context 
-                if f["file_path"] in current_files
-            ]
-            chunks.append(current_chunk)
+                files_context=_dedupe_contexts(
+                    f for file_path in chunk_files
+                    for f in files_by_path.get(file_path, ())
+                ),
+                metadata=context.metadata
+            ))
         
-        logger.info("Split code into {} chunks with total size: {} characters", 
-                    len(chunks) if chunks else 0, 
-                    sum(len(chunk.diff) if hasattr(chunk, 'diff') else 0 for chunk in chunks) if chunks else 0)
+        logger.opt(lazy=True).info("Split code into {} chunks with total size: {} characters", 
+                                   lambda: len(chunks), 
+                                   lambda: sum(len(chunk.diff) for chunk in chunks))
         return chunks
 
-    async def analyze_code(self, context: CodeContext) -> ReviewResult:
-        chunks = self._split_code_chunks(context)
-        results = []
-        
-        for i, chunk in enumerate(chunks):
-            logger.info("Analyzing chunk {}/{} with size: {} characters", 
-                        i + 1, len(chunks) if chunks else 0, 
-                        len(chunk.diff) if hasattr(chunk, 'diff') else 0)
-            
-            # 格式化文件上下文
-            files_context_str = "\n\n".join(
-                f"文件: {f['file_path']} ({f['file_type']})\n{f['context']}"
-                for f in chunk.files_context
-            ) if chunk.files_context else "无文件上下文"
-            
-            # 验证必需的参数
-            if not context.metadata.get("commit_message"):
-                logger.error("Missing commit message in metadata for commit: {}", 
-                             context.metadata.get("commit_id", "unknown")[:8] if context and hasattr(context, 'metadata') else "unknown")
-                raise ValueError("Missing commit message in metadata")
-                
-            if not chunk.diff:
-                logger.error("Missing diff content for commit: {}", 
-                             context.metadata.get("commit_id", "unknown")[:8] if context and hasattr(context, 'metadata') else "unknown")
-                raise ValueError("Missing diff content")
-            
-            try:
-                prompt = REVIEW_PROMPT.format(
-                    commit_message=context.metadata["commit_message"],
-                    diff=chunk.diff,
-                    files_context=files_context_str
-                )
-            except KeyError as ke:
-                logger.error("Error formatting prompt - missing key: {}", ke)
-                raise ValueError(f"Missing required field for prompt formatting: {ke}")
-            except Exception as e:
-                logger.error("Error formatting prompt: {}", str(e))
-                raise ValueError(f"Failed to format prompt: {str(e)}")
-                
-            if not prompt:
-                logger.error("Empty prompt after formatting")
-                raise ValueError("Empty prompt after formatting")
-            
+    async def _analyze_chunk(self, chunk: CodeContext, index: int, total: int, context: CodeContext) -> ReviewResult:
+        """评审单个chunk，解析失败时返回默认结果"""
+        logger.info("Analyzing chunk {}/{} with size: {} characters", 
+                    index + 1, total, 
+                    len(chunk.diff))
+
+        # 格式化文件上下文
+        files_context_str = "\n\n".join(
+            f"文件: {f['file_path']} ({f['file_type']})\n{f['context']}"
+            for f in chunk.files_context
+        ) if chunk.files_context else "无文件上下文"
+
+        if not chunk.diff:
+            logger.error("Missing diff content for commit: {}", 
+                         context.metadata.get("commit_id", "unknown")[:8])
+            raise ValueError("Missing diff content")
+
+        cache_key = chunk.cache_key(self.model_name)
+        cached = self._chunk_cache.get(cache_key)
+        if cached is not None:
+            self._chunk_cache.move_to_end(cache_key)
+            logger.info("Using cached review result for chunk {}/{}", index + 1, total)
+            return cached
+
+        prompt = _build_prompt(context.metadata["commit_message"], chunk.diff, files_context_str)
+
+        try:
+            logger.info("Sending request to LLM model: {} with prompt size: {} characters", 
+                        self.model_name, 
+                        len(prompt))
+
             try:
-                logger.info("Sending request to LLM model: {} with prompt size: {} characters", 
-                            self.model_name if hasattr(self, 'model_name') else "unknown", 
-                            len(prompt) if prompt else 0)
-                
-                try:
-                    response = await litellm.acompletion(
+                async with self._semaphore, self._rate_limiter:
+                    response = await self.router.acompletion(
                         model=self.model_name,
-                        messages=[{"role": "user", "content": prompt}],
+                        messages=[
+                            _SYSTEM_MESSAGE,
+                            {"role": "user", "content": prompt}
+                        ],
                         temperature=0.2
                     )
-                    logger.info("Received response from LLM with size: {} characters", 
-                                len(str(response)) if response else 0)
-                    
-                    if not response or not hasattr(response, 'choices') or not response.choices:
-                        logger.error("Invalid response format from LLM. Expected JSON, got: {}", 
-                                     type(response).__name__ if response else "None")
-                        raise ValueError("Invalid response format from LLM")
-                        
-                    response_text = response.choices[0].message.content
-                except Exception as llm_error:
-                    logger.error("Error calling LLM model {}: {}", 
-                                 self.model_name if hasattr(self, 'model_name') else "unknown", 
-                                 str(llm_error))
-                    raise
-                
-                response_text = response_text.strip()
-                
-                # 查找JSON内容的开始和结束位置
-                json_start = response_text.find("{")
-                json_end = response_text.rfind("}") + 1
-                
-                if json_start == -1 or json_end <= json_start:
-                    logger.error("No valid JSON found in response of size: {} characters", 
-                                 len(str(response)) if response else 0)
-                    # 返回默认结果而不是抛出异常
-                    return ReviewResult(
-                        score=0,
-                        issues=[],
-                        security_issues=[],
-                        quality_metrics=QualityMetrics(
-                            security_score=0,
-                            performance_score=0,
-                            readability_score=0,
-                            best_practice_score=0
-                        )
+                # str(response)会序列化整个响应对象，仅在INFO日志实际输出时计算
+                logger.opt(lazy=True).info("Received response from LLM with size: {} characters", 
+                                           lambda: len(str(response)) if response else 0)
+                logger.opt(lazy=True).debug("Prompt cache hit: {} tokens", lambda: _cached_tokens(response))
+
+                if not response or not hasattr(response, 'choices') or not response.choices:
+                    logger.error("Invalid response format from LLM. Expected JSON, got: {}", 
+                                 type(response).__name__ if response else "None")
+                    raise ValueError("Invalid response format from LLM")
+
+                response_text = response.choices[0].message.content
+            except Exception as llm_error:
+                logger.error("Error calling LLM model {}: {}", 
+                             self.model_name, 
+                             str(llm_error))
+                raise
+
+            response_text = response_text.strip()
+
+            # 查找JSON内容的开始位置
+            json_start = response_text.find("{")
+
+            if json_start == -1:
+                logger.error("No valid JSON found in response of size: {} characters", 
+                             len(str(response)) if response else 0)
+                # 返回默认结果而不是抛出异常
+                return ReviewResult(
+                    score=0,
+                    issues=[],
+                    security_issues=[],
+                    quality_metrics=QualityMetrics(
+                        security_score=0,
+                        performance_score=0,
+                        readability_score=0,
+                        best_practice_score=0
                     )
-                
-                response_text = response_text[json_start:json_end]
-                
-                try:
-                    import json
-                    # 尝试清理和格式化 JSON 字符串
-                    response_text = response_text.replace('\n', ' ').replace('\r', '')
-                    # 处理可能的 markdown 代码块
-                    if '```json' in response_text:
-                        response_text = response_text.split('```json')[-1].split('```')[0]
-                    elif '```' in response_text:
-                        response_text = response_text.split('```')[-2]
-                    
-                    # 先尝试解析JSON
-                    json_obj = json.loads(response_text)
-                    
-                    # 确保所有必需的字段都存在并且类型正确
-                    required_fields = {
-                        "score": float,
-                        "issues": list,
-                        "security_issues": list,
-                        "quality_metrics": dict
-                    }
-                    
-                    for field, field_type in required_fields.items():
-                        if field not in json_obj:
-                            logger.warning("Missing required field: {} in response for commit: {}, adding default value", 
-                                           field, context.metadata.get("commit_id", "unknown")[:8] if context and hasattr(context, 'metadata') else "unknown")
-                            if field == "issues":
-                                json_obj["issues"] = []
-                            elif field == "security_issues":
-                                json_obj["security_issues"] = []
-                            elif field == "quality_metrics":
-                                json_obj["quality_metrics"] = {
-                                    "security_score": 0.0,
-                                    "performance_score": 0.0,
-                                    "readability_score": 0.0,
-                                    "best_practice_score": 0.0
-                                }
-                            elif field == "score":
-                                json_obj["score"] = 0.0
-                        elif not isinstance(json_obj[field], field_type):
-                            logger.warning("Field {} has wrong type. Expected {}, got {}. Converting to default value.", 
-                                           field, field_type.__name__ if hasattr(field_type, '__name__') else str(field_type), 
-                                           type(json_obj[field]).__name__ if json_obj and field in json_obj else "unknown")
-                            if field == "issues":
-                                json_obj["issues"] = []
-                            elif field == "security_issues":
-                                json_obj["security_issues"] = []
-                            elif field == "quality_metrics":
-                                json_obj["quality_metrics"] = {
-                                    "security_score": 0.0,
-                                    "performance_score": 0.0,
-                                    "readability_score": 0.0,
-                                    "best_practice_score": 0.0
-                                }
-                            elif field == "score":
-                                json_obj["score"] = 0.0
-                    
-                    # 检查 quality_metrics 的字段
-                    required_metrics = {
-                        "security_score": float,
-                        "performance_score": float,
-                        "readability_score": float,
-                        "best_practice_score": float
-                    }
-                    
-                    if "quality_metrics" in json_obj:
-                        for metric, metric_type in required_metrics.items():
-                            if metric not in json_obj["quality_metrics"]:
-                                logger.warning("Missing required metric: {} in quality metrics for commit: {}, adding default value", 
-                                               metric, context.metadata.get("commit_id", "unknown")[:8] if context and hasattr(context, 'metadata') else "unknown")
-                                json_obj["quality_metrics"][metric] = 0.0
-                            elif not isinstance(json_obj["quality_metrics"][metric], metric_type):
-                                json_obj["quality_metrics"][metric] = float(json_obj["quality_metrics"][metric])
-                    
-                    result = ReviewResult.parse_obj(json_obj)
-                    results.append(result)
-                    logger.info("Successfully analyzed chunk {}/{} for commit: {}", 
-                                i + 1, len(chunks) if chunks else 0, 
-                                context.metadata.get("commit_id", "unknown")[:8] if context and hasattr(context, 'metadata') else "unknown")
-                except json.JSONDecodeError as json_error:
-                    logger.error("JSON parsing error at position {} in response of size {}: {}", 
-                                 getattr(json_error, 'pos', 0), 
-                                 len(str(response)) if response else 0, 
-                                 str(json_error))
-                    raise
-                except Exception as parse_error:
-                    logger.error("Error parsing LLM response of size {}: {}", 
-                                 len(str(response)) if response else 0, 
-                                 str(parse_error))
-                    # 返回一个默认的评审结果
-                    results.append(ReviewResult(
-                        score=0,
-                        issues=[],
-                        security_issues=[],
-                        quality_metrics=QualityMetrics(
-                            security_score=0,
-                            performance_score=0,
-                            readability_score=0,
-                            best_practice_score=0
-                        )
-                    ))
-            except Exception as e:
-                logger.error("Error getting LLM response for model {}: {}", 
-                             self.model_name if hasattr(self, 'model_name') else "unknown", 
-                             str(e))
+                )
+
+            try:
+                json_obj = _extract_json(response_text, json_start)
+
+                # 缺失的字段使用模型默认值，类型不符时校验失败，按解析错误处理
+                result = ReviewResult.model_validate(json_obj)
+                # 响应中没有给出评分时结果全为默认值，不缓存，下次评审重新请求
+                if "score" in result.model_fields_set:
+                    self._cache_chunk_result(cache_key, result)
+                logger.info("Successfully analyzed chunk {}/{} for commit: {}", 
+                            index + 1, total, 
+                            context.metadata.get("commit_id", "unknown")[:8])
+                return result
+            except json.JSONDecodeError as json_error:
+                logger.error("JSON parsing error at position {} in response of size {}: {}", 
+                             getattr(json_error, 'pos', 0), 
+                             len(str(response)) if response else 0, 
+                             str(json_error))
                 raise
+            except Exception as parse_error:
+                logger.error("Error parsing LLM response of size {}: {}", 
+                             len(str(response)) if response else 0, 
+                             str(parse_error))
+                # 返回一个默认的评审结果
+                return ReviewResult(
+                    score=0,
+                    issues=[],
+                    security_issues=[],
+                    quality_metrics=QualityMetrics(
+                        security_score=0,
+                        performance_score=0,
+                        readability_score=0,
+                        best_practice_score=0
+                    )
+                )
+        except Exception as e:
+            logger.error("Error getting LLM response for model {}: {}", 
+                         self.model_name, 
+                         str(e))
+            raise
+
+    def _cache_chunk_result(self, cache_key: str, result: ReviewResult) -> None:
+        """写入chunk评审结果缓存，超出容量时淘汰最久未使用的条目"""
+        cache_size = self.config.cache_size
+        if cache_size <= 0:
+            return
+        self._chunk_cache[cache_key] = result
+        while len(self._chunk_cache) > cache_size:
+            self._chunk_cache.popitem(last=False)
+
+    async def analyze_code(self, context: CodeContext) -> Optional[ReviewResult]:
+        """评审整个commit，所有chunk都没有可评审的变更时返回None"""
+        chunks = self._split_code_chunks(context)
+        # 只包含二进制文件或空行变更的chunk没有可评审的内容，跳过LLM调用
+        reviewable = [chunk for chunk in chunks if _has_reviewable_changes(chunk.diff)]
+        if len(reviewable) < len(chunks):
+            logger.info("Skipped {} chunks without reviewable changes for commit: {}", 
+                        len(chunks) - len(reviewable), 
+                        context.metadata.get("commit_id", "unknown")[:8])
+            if not reviewable:
+                # 不评分，由调用方像没有可评审文件的commit一样跳过
+                return None
+            chunks = reviewable
+        
+        # 验证必需的参数
+        if chunks and not context.metadata.get("commit_message"):
+            logger.error("Missing commit message in metadata for commit: {}", 
+                         context.metadata.get("commit_id", "unknown")[:8])
+            raise ValueError("Missing commit message in metadata")
+
+        # 各chunk的LLM请求并发执行，结果保持chunk顺序
+        outcomes = await asyncio.gather(
+            *(self._analyze_chunk(chunk, i, len(chunks), context) for i, chunk in enumerate(chunks)),
+            return_exceptions=True
+        )
+        # 任一chunk失败则整个commit的评审失败，避免漏评的代码拿到通过分数
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        results = list(outcomes)
         
         # 合并所有chunk的结果
         if not results:
             logger.warning("No valid results for commit: {} in model: {}", 
-                           context.metadata.get("commit_id", "unknown")[:8] if context and hasattr(context, 'metadata') else "unknown", 
-                           self.model_name if hasattr(self, 'model_name') else "unknown")
+                           context.metadata.get("commit_id", "unknown")[:8], 
+                           self.model_name)
             return ReviewResult(
                 score=0,
                 issues=[],
@@ -440,20 +628,10 @@ class LLMService:
                 )
             )
         
-        # 使用最低分作为最终分数
-        final_result = ReviewResult(
-            score=min(r.score for r in results),
-            issues=[i for r in results for i in r.issues],
-            security_issues=[i for r in results for i in r.security_issues],
-            quality_metrics=QualityMetrics(
-                security_score=min(r.quality_metrics.security_score for r in results),
-                performance_score=min(r.quality_metrics.performance_score for r in results),
-                readability_score=min(r.quality_metrics.readability_score for r in results),
-                best_practice_score=min(r.quality_metrics.best_practice_score for r in results)
-            )
-        )
+        # 单个chunk（最常见的情况）直接使用其结果，无需合并
+        final_result = results[0] if len(results) == 1 else _merge_results(results)
         
         logger.info("Analysis completed for commit {} with final score: {}", 
-                    context.metadata.get("commit_id", "unknown")[:8] if context and hasattr(context, 'metadata') else "unknown", 
-                    final_result.score if final_result and hasattr(final_result, 'score') else 0.0)
+                    context.metadata.get("commit_id", "unknown")[:8], 
+                    final_result.score)
         return final_result 
\ No newline at end of file